@@ -1,16 +1,41 @@
 
 from flask_pymongo import PyMongo
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.write_concern import WriteConcern
 
 from datetime import datetime, timedelta
+import hashlib
+import math
+import mimetypes
 import os
-from flask import Flask, request, jsonify, send_from_directory, abort
+import time
+import uuid
+import zlib
+import orjson
+from flask import Flask, request, jsonify, send_from_directory, abort, make_response
+from flask.json.provider import JSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from flask_jwt_extended import (
     JWTManager, create_access_token, jwt_required, get_jwt_identity
 )
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_cors import CORS
+from flask_compress import Compress
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from redis import Redis
+from redis.exceptions import RedisError
+from rq import Queue
+from sqlalchemy import event, insert, inspect, select, text, update
+from sqlalchemy.exc import IntegrityError
+from argon2 import PasswordHasher, Type, extract_parameters
+from argon2.exceptions import InvalidHashError, VerificationError
+from argon2.low_level import ARGON2_VERSION
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import FileTarget, ValueTarget
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
@@ -18,21 +43,129 @@ DB_PATH = os.path.join(BASE_DIR, 'navi_x.db')
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+class ORJSONProvider(JSONProvider):
+    # orjson encodes in C and writes datetimes as ISO-8601 itself; naive datetimes are UTC here (utcnow)
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
-app.config["MONGO_URI"] = "mongodb://localhost:27017/navi_x"  # local MongoDB
+# One lazily-connected pool per worker process, sized for the gevent worker connections
+app.config["MONGO_URI"] = os.environ.get(
+    "MONGO_URI",
+    "mongodb://localhost:27017/navi_x"  # local MongoDB
+    "?maxPoolSize=50&minPoolSize=5&maxIdleTimeMS=30000&serverSelectionTimeoutMS=2000&connect=false",
+)
 # app.config["MONGO_URI"] = "your_atlas_connection_string"  # for Atlas
 app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_PATH}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# sqlite3 blocks the gevent hub, so a bigger pool adds no concurrency; it only keeps connections
+# (and their page caches) around. pre_ping drops connections that died while idle
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 20, 'pool_pre_ping': True}
 app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'replace_this_with_a_secure_key')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 8 * 1024 * 1024  # 8 MB max upload
+app.config['MAX_CONTENT_LENGTH'] = 32 * 1024 * 1024  # 32 MB max upload (streamed to disk)
+# Let the front proxy send upload bytes: X-Sendfile (Apache/lighttpd) or an nginx internal location
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+app.config['UPLOADS_ACCEL_REDIRECT'] = os.environ.get('UPLOADS_ACCEL_REDIRECT')  # e.g. '/internal-uploads/'
+# Proxies in front of the app whose X-Forwarded-For we trust (usually 1 behind nginx).
+# Without this, remote_addr is the proxy and every client shares one login rate-limit bucket;
+# with it, gunicorn binds to loopback so clients can't reach the app and forge the header.
+app.config['TRUSTED_PROXY_HOPS'] = int(os.environ.get('TRUSTED_PROXY_HOPS', '0'))
+if app.config['TRUSTED_PROXY_HOPS']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXY_HOPS'])
+# Per-process counters by default, so each gunicorn worker grants the full limit;
+# point at redis:// for one shared budget
+app.config['RATELIMIT_STORAGE_URI'] = os.environ.get('RATELIMIT_STORAGE_URI', 'memory://')
+# Post-upload jobs go to an rq queue; without Redis they run inline in the request
+app.config['REDIS_URL'] = os.environ.get('REDIS_URL')
+# Bus lists/reports repeat the same keys and statuses per row; level 4 keeps compression cheap
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_LEVEL'] = 4
+app.config['COMPRESS_BR_LEVEL'] = 4
+app.config['COMPRESS_MIN_SIZE'] = 500
 
 #CORS(app, supports_credentials=True)
 CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
+Compress(app)
 
 mongo = PyMongo(app)
+app.json = ORJSONProvider(app)
 db = SQLAlchemy(app)
 jwt = JWTManager(app)
+limiter = Limiter(get_remote_address, app=app, default_limits=[])
+# Short timeouts so a hung Redis falls back to inline processing instead of stalling registration
+upload_queue = Queue('uploads', connection=Redis.from_url(
+    app.config['REDIS_URL'], socket_connect_timeout=2, socket_timeout=2
+)) if app.config['REDIS_URL'] else None
+
+@app.errorhandler(429)
+def rate_limited(e):
+    return jsonify({'msg': f'Too many attempts, try again later ({e.description})'}), 429
+
+def _set_sqlite_pragmas(dbapi_con, _):
+    # WAL lets readers run alongside the single writer; NORMAL only fsyncs at checkpoints.
+    # Reads go through a 256 MB mmap and a 64 MB page cache per connection.
+    cur = dbapi_con.cursor()
+    cur.execute('PRAGMA journal_mode=WAL')
+    cur.execute('PRAGMA synchronous=NORMAL')
+    cur.execute('PRAGMA mmap_size=268435456')
+    cur.execute('PRAGMA cache_size=-65536')
+    cur.execute('PRAGMA temp_store=MEMORY')
+    cur.close()
+
+with app.app_context():
+    event.listen(db.engine, 'connect', _set_sqlite_pragmas)
+
+# --- Password hashing ---------------------------------------
+# memory_cost is pinned in config so every worker hashes with the same parameters.
+# Pick it with `flask --app backend calibrate-argon2`; each hash blocks a whole gevent worker.
+ARGON2_TARGET_SECONDS = 0.1  # calibration budget per hash
+ARGON2_MIN_MEMORY_COST = 19456  # KiB, OWASP minimum for Argon2id
+ARGON2_DEFAULT_MEMORY_COST = 65536  # KiB; lower it if calibrate-argon2 says this host is too slow
+app.config['ARGON2_MEMORY_COST'] = max(
+    int(os.environ.get('ARGON2_MEMORY_COST', ARGON2_DEFAULT_MEMORY_COST)), ARGON2_MIN_MEMORY_COST
+)
+
+def _make_hasher(memory_cost):
+    return PasswordHasher(time_cost=3, memory_cost=memory_cost, parallelism=2, hash_len=32, salt_len=16)
+
+def _tune_hasher(memory_cost=ARGON2_DEFAULT_MEMORY_COST):
+    # Halve memory_cost until a single hash fits the target, never going below the OWASP floor
+    ph = _make_hasher(memory_cost)
+    while memory_cost > ARGON2_MIN_MEMORY_COST:
+        start = time.perf_counter()
+        ph.hash('navi_x-calibration')
+        if time.perf_counter() - start <= ARGON2_TARGET_SECONDS:
+            break
+        memory_cost = max(memory_cost // 2, ARGON2_MIN_MEMORY_COST)
+        ph = _make_hasher(memory_cost)
+    return ph
+
+PH = _make_hasher(app.config['ARGON2_MEMORY_COST'])
+# Every hash PH produces shares this '$argon2id$v=19$m=...,t=...,p=...$' prefix and total length
+# (salt_len/hash_len fix the rest), so current-params checks are a string compare, not a re-parse
+_PH_SAMPLE = PH.hash('navi_x-calibration')
+PH_PREFIX = _PH_SAMPLE.rsplit('$', 2)[0] + '$'
+PH_HASH_LENGTH = len(_PH_SAMPLE)
+
+def is_weaker_hash(password_hash):
+    # True for legacy werkzeug hashes and Argon2 hashes with weaker parameters than PH;
+    # stronger ones are left alone so a lower ARGON2_MEMORY_COST never forces a rewrite
+    try:
+        params = extract_parameters(password_hash)
+    except InvalidHashError:
+        return True
+    return (
+        params.type is not Type.ID
+        or params.version < ARGON2_VERSION
+        or params.memory_cost < PH.memory_cost
+        or params.time_cost < PH.time_cost
+        or params.hash_len < PH.hash_len
+        or params.salt_len < PH.salt_len
+    )
 
 # --- Models -------------------------------------------------
 class Authority(db.Model):
@@ -42,11 +175,28 @@ class Authority(db.Model):
     department = db.Column(db.String(120), nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
     doc_filename = db.Column(db.String(256))
+    doc_sha256 = db.Column(db.String(64))  # filled in by tasks.postprocess_upload
     verified = db.Column(db.Boolean, default=False)
     registered_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        try:
+            PH.verify(self.password_hash, password)
+            return True
+        except VerificationError:
+            # Mismatch, or a stored '$argon2id$...' value that is corrupt
+            return False
+        except InvalidHashError:
+            if self.password_hash.startswith('$argon2'):
+                return False  # corrupt Argon2 value; werkzeug would raise on its empty method
+            # Legacy werkzeug hash from before the Argon2 switch
+            return check_password_hash(self.password_hash, password)
+
+    def needs_rehash(self):
+        # Current-params hashes take the string compare; anything else is parsed
+        if len(self.password_hash) == PH_HASH_LENGTH and self.password_hash.startswith(PH_PREFIX):
+            return False
+        return is_weaker_hash(self.password_hash)
 
     def to_dict(self):
         return {
@@ -55,45 +205,179 @@ class Authority(db.Model):
             "email": self.email,
             "department": self.department,
             "verified": self.verified,
-            "registered_at": self.registered_at.isoformat() if self.registered_at else None,
-            "doc_filename": self.doc_filename
+            "registered_at": self.registered_at,
+            "doc_filename": self.doc_filename,
+            "doc_sha256": self.doc_sha256
         }
 
-class Bus:
-    def __init__(self, name, route, lat=0.0, lng=0.0, status='On Time', driver='Unknown', speed=0, capacity=40, passengers=0):
-        self.name = name
-        self.route = route
-        self.lat = lat
-        self.lng = lng
-        self.status = status
-        self.driver = driver
-        self.speed = speed
-        self.capacity = capacity
-        self.passengers = passengers
-        self.updated_at = datetime.utcnow()
-
-    def to_dict(self, include_id=True, mongo_id=None):
+class Bus(db.Model):
+    __table_args__ = (db.Index('ix_bus_route_status', 'route', 'status'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), nullable=False, index=True)
+    route = db.Column(db.String(80), nullable=False, index=True)
+    status = db.Column(db.String(40), default='On Time', index=True)
+    driver = db.Column(db.String(80), default='Unknown')
+    capacity = db.Column(db.Integer, default=40)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self, telemetry=None, include_id=True):
+        # Static fields live here; lat/lng/speed/passengers come from the Mongo telemetry document
         data = {
             'name': self.name,
             'route': self.route,
-            'lat': self.lat,
-            'lng': self.lng,
             'status': self.status,
             'driver': self.driver,
-            'speed': self.speed,
             'capacity': self.capacity,
-            'passengers': self.passengers,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+            'updated_at': self.updated_at
         }
-        if include_id and mongo_id:
-            data['id'] = str(mongo_id)
-        return data
+        if include_id:
+            data['id'] = self.id
+        return merge_telemetry(data, telemetry)
 
 # --- Helpers ------------------------------------------------
-ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg'}
+ALLOWED_EXTENSIONS = frozenset(('pdf', 'png', 'jpg', 'jpeg'))
+
+REGISTER_FIELDS = ('username', 'email', 'department', 'password')
+BUS_FIELDS = ('name', 'route', 'status', 'driver', 'capacity')
+TELEMETRY_FIELDS = ('lat', 'lng', 'speed', 'passengers')
+TELEMETRY_DEFAULTS = {'lat': 0.0, 'lng': 0.0, 'speed': 0, 'passengers': 0}
+TELEMETRY_TYPES = {'lat': float, 'lng': float, 'speed': float, 'passengers': int}
+# The 2dsphere index on loc rejects points outside these, so check before anything is written
+TELEMETRY_RANGES = {'lat': (-90.0, 90.0), 'lng': (-180.0, 180.0)}
+STREAM_CHUNK_SIZE = 64 * 1024
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    # One right-to-left scan: dot is '' when there's no extension at all
+    _, dot, ext = filename.rpartition('.')
+    return bool(dot) and ext.lower() in ALLOWED_EXTENSIONS
+
+def parse_registration_stream():
+    # Stream a multipart body straight to disk instead of going through werkzeug's form parser.
+    # Returns (fields, original_filename, temp_path); temp_path is None when no file was sent.
+    # Raises ValueError for a malformed body, after removing any partial upload.
+    values = {name: ValueTarget() for name in REGISTER_FIELDS}
+    temp_path = os.path.join(app.config['UPLOAD_FOLDER'], f".upload_{uuid.uuid4().hex}.part")
+    file_target = FileTarget(temp_path)
+
+    try:
+        parser = StreamingFormDataParser(headers=dict(request.headers))
+        for name, target in values.items():
+            parser.register(name, target)
+        parser.register('file', file_target)
+
+        while chunk := request.stream.read(STREAM_CHUNK_SIZE):
+            parser.data_received(chunk)
+        fields = {name: target.value.decode('utf-8') or None for name, target in values.items()}
+    except (ParseFailedException, UnicodeDecodeError) as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise ValueError(str(e)) from e
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    if not os.path.exists(temp_path):
+        return fields, None, None
+    return fields, file_target.multipart_filename, temp_path
+
+def parse_telemetry(data):
+    # Coerce the telemetry fields present in a request body; ValueError names the first bad one
+    telemetry = {}
+    for field, cast in TELEMETRY_TYPES.items():
+        if field not in data:
+            continue
+        try:
+            value = cast(data[field])
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError(f'Invalid {field}') from None
+        low, high = TELEMETRY_RANGES.get(field, (-math.inf, math.inf))
+        if not (math.isfinite(value) and low <= value <= high):
+            raise ValueError(f'Invalid {field}')
+        telemetry[field] = value
+    return telemetry
+
+BUS_COLUMNS = (Bus.id,) + tuple(getattr(Bus, field) for field in BUS_FIELDS) + (Bus.updated_at,)
+
+# --- Telemetry (MongoDB `buses` collection, _id = Bus.id) ---
+# Telemetry is overwritten every tick, so an acknowledged-but-unjournaled write is good enough
+TELEMETRY_WRITE_CONCERN = WriteConcern(w=1, j=False)
+
+def create_telemetry_indexes():
+    mongo.db.buses.create_index([('loc', '2dsphere')])
+    mongo.db.buses.create_index('updated_at')
+
+def telemetry_update(values):
+    # $set for the given fields; a freshly upserted document gets defaults for the rest
+    values = dict(values)
+    if 'lat' in values:
+        values['lat'], values['lng'] = float(values['lat']), float(values['lng'])
+        values['loc'] = {'type': 'Point', 'coordinates': [values['lng'], values['lat']]}
+    values['updated_at'] = datetime.utcnow()
+    on_insert = {k: v for k, v in TELEMETRY_DEFAULTS.items() if k not in values}
+    if 'loc' not in values:
+        on_insert['loc'] = {'type': 'Point', 'coordinates': [TELEMETRY_DEFAULTS['lng'], TELEMETRY_DEFAULTS['lat']]}
+    return {'$set': values, '$setOnInsert': on_insert}
+
+def save_telemetry(bus_id, values):
+    # One upsert per tick; returns the updated document (without _id/loc)
+    if ('lat' in values) != ('lng' in values):
+        # loc needs both coordinates, so fill in the one that wasn't sent
+        current = mongo.db.buses.find_one({'_id': bus_id}, {'lat': 1, 'lng': 1}) or TELEMETRY_DEFAULTS
+        values = {'lat': current['lat'], 'lng': current['lng'], **values}
+    return mongo.db.buses.with_options(write_concern=TELEMETRY_WRITE_CONCERN).find_one_and_update(
+        {'_id': bus_id}, telemetry_update(values), projection={'_id': 0, 'loc': 0},
+        upsert=True, return_document=ReturnDocument.AFTER
+    )
+
+def load_telemetry(bus_ids=None):
+    query = {} if bus_ids is None else {'_id': {'$in': list(bus_ids)}}
+    return {doc.pop('_id'): doc for doc in mongo.db.buses.find(query, {'loc': 0})}
+
+def merge_telemetry(data, telemetry):
+    # Fold a telemetry document into a bus dict; updated_at is the later of the two stores
+    tel = telemetry or {}
+    for field in TELEMETRY_FIELDS:
+        data[field] = tel.get(field, TELEMETRY_DEFAULTS[field])
+    if tel.get('updated_at') and (data['updated_at'] is None or tel['updated_at'] > data['updated_at']):
+        data['updated_at'] = tel['updated_at']
+    return data
+
+# Serialized /api/buses payload, reused until the shared bus-list version moves
+_bus_list_cache = {'key': None, 'etag': None, 'body': None}
+
+def bump_bus_list_version():
+    # Every bus write ends with this $inc, so all workers see that their cached listing is stale.
+    # A counter, unlike MAX(updated_at), moves even when writes land out of timestamp order.
+    mongo.db.meta.update_one({'_id': 'bus_list'}, {'$inc': {'version': 1}}, upsert=True)
+
+def bus_list_version():
+    doc = mongo.db.meta.find_one({'_id': 'bus_list'}, {'version': 1})
+    return doc and doc['version']
+
+def update_bus_row(bus_id, values, telemetry=None):
+    # Single UPDATE ... RETURNING instead of SELECT + mutate + flush; 404s if the bus doesn't exist.
+    # Telemetry fields go to Mongo as one upsert after the SQL commit.
+    if values:
+        bus = db.session.execute(
+            update(Bus).where(Bus.id == bus_id).values(**values).returning(Bus)
+        ).scalar_one_or_none()
+    else:
+        bus = db.session.get(Bus, bus_id)
+    if bus is None:
+        abort(404)
+    data = bus.to_dict()
+    db.session.commit()
+    try:
+        if telemetry:
+            doc = save_telemetry(bus_id, telemetry)
+        else:
+            doc = load_telemetry([bus_id]).get(bus_id)
+    finally:
+        if values or telemetry:
+            bump_bus_list_version()
+    return merge_telemetry(data, doc)
 
 # --- Routes --------------------------------------------------
 
@@ -101,39 +385,74 @@ def allowed_file(filename):
 @app.route('/api/register', methods=['POST'])
 def register_authority():
     # Accepts multipart/form-data with fields: username, email, department, password, file
-    username = request.form.get('username')
-    email = request.form.get('email')
-    department = request.form.get('department')
-    password = request.form.get('password')
-    file = request.files.get('file')
+    if request.mimetype == 'multipart/form-data':
+        try:
+            fields, upload_name, temp_path = parse_registration_stream()
+        except ValueError:
+            return jsonify({'msg': 'Malformed multipart body'}), 400
+    else:
+        # Fallback for urlencoded bodies etc.: let werkzeug parse them
+        fields = {name: request.form.get(name) for name in REGISTER_FIELDS}
+        file = request.files.get('file')
+        upload_name, temp_path = (file.filename, None) if file else (None, None)
 
-    if not (username and email and password and department and file):
-        return jsonify({'msg': 'Missing required fields'}), 400
+    def reject(msg):
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+        return jsonify({'msg': msg}), 400
 
-    if not allowed_file(file.filename):
-        return jsonify({'msg': 'File type not allowed'}), 400
+    username = fields['username']
+    email = fields['email']
+    department = fields['department']
+    password = fields['password']
 
-    if Authority.query.filter((Authority.username == username) | (Authority.email == email)).first():
-        return jsonify({'msg': 'Username or email already registered'}), 400
+    if not (username and email and password and department and upload_name):
+        return reject('Missing required fields')
 
-    filename = secure_filename(f"{username}_{int(datetime.utcnow().timestamp())}_{file.filename}")
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(filepath)
+    if not allowed_file(upload_name):
+        return reject('File type not allowed')
+
+    filename = secure_filename(f"{username}_{int(datetime.utcnow().timestamp())}_{upload_name}")
 
     auth = Authority(
         username=username,
         email=email,
         department=department,
-        password_hash=generate_password_hash(password),
+        password_hash=PH.hash(password),
         doc_filename=filename,
         verified=True  # In a real app, set false and verify manually
     )
+    # The UNIQUE constraints on username/email reject duplicates (also under concurrent registrations).
+    # Commit before moving the upload into place so a rejected duplicate can't overwrite a stored file.
     db.session.add(auth)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return reject('Username or email already registered')
 
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if temp_path:
+        os.replace(temp_path, filepath)
+    else:
+        file.save(filepath)
+
+    # Checksumming (and any future scanning) runs on an rq worker; 202 tells the client it's still pending
+    # If Redis is unreachable the account already exists, so fall back to running the job inline
+    if upload_queue is not None:
+        try:
+            upload_queue.enqueue('tasks.postprocess_upload', auth.id, filepath)
+            return jsonify({'msg': 'Registration successful', 'authority': auth.to_dict()}), 202
+        except RedisError:
+            app.logger.warning('Redis unavailable, post-processing upload for authority %s inline', auth.id)
+
+    from tasks import postprocess_upload
+    postprocess_upload(auth.id, filepath)
+    db.session.refresh(auth)
     return jsonify({'msg': 'Registration successful', 'authority': auth.to_dict()}), 201
 
 @app.route('/api/login', methods=['POST'])
+@limiter.limit('10/minute;100/hour')  # caps how many password hashes one client can make us compute
 def login():
     data = request.get_json(force=True)
     identifier = data.get('identifier')
@@ -146,20 +465,60 @@ def login():
     if not auth or not auth.check_password(password):
         return jsonify({'msg': 'Bad username/email or password'}), 401
 
+    if auth.needs_rehash():
+        auth.password_hash = PH.hash(password)
+        db.session.commit()
+
     access_token = create_access_token(identity=auth.username, expires_delta=timedelta(hours=8))
 
     return jsonify({'access_token': access_token, 'authority': auth.to_dict()}), 200
 
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    # Serve uploaded files (only for development)
+    # Behind nginx, hand the transfer off to an internal location, e.g.
+    #   location /internal-uploads/ { internal; alias /path/to/uploads/; }
+    accel_prefix = app.config['UPLOADS_ACCEL_REDIRECT']
+    if accel_prefix:
+        filename = secure_filename(filename)
+        resp = make_response('', 200)
+        resp.headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{filename}"
+        resp.headers['Content-Type'] = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        return resp
+    # Otherwise Flask streams the file itself (or emits X-Sendfile when USE_X_SENDFILE is on)
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
 # --- Bus endpoints ------------------------------------------
 @app.route('/api/buses', methods=['GET'])
 def list_buses():
-    buses = Bus.query.all()
-    return jsonify([b.to_dict() for b in buses])
+    # Read the version before the data: a write racing with the rebuild bumps it again afterwards
+    key = bus_list_version()
+    if key is None or key != _bus_list_cache['key']:
+        # Plain column tuples: no ORM objects or identity map for a read-only listing
+        telemetry = load_telemetry()
+        buses = [
+            merge_telemetry(row._asdict(), telemetry.get(row.id))
+            for row in db.session.execute(select(*BUS_COLUMNS))
+        ]
+        body = orjson.dumps(buses, option=orjson.OPT_NAIVE_UTC)
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        _bus_list_cache.update(key=key, etag=etag, body=body)
+    else:
+        etag, body = _bus_list_cache['etag'], _bus_list_cache['body']
+
+    # flask-compress suffixes the ETag of compressed bodies with ':br' / ':gzip'. Only accept the
+    # suffix this request would get, so a shared cache never pairs a br tag with a gzip-only client.
+    encoding = (
+        request.accept_encodings.best_match(app.config['COMPRESS_ALGORITHM'])
+        if len(body) >= app.config['COMPRESS_MIN_SIZE'] else None
+    )
+    tag = f'{etag}:{encoding}' if encoding else etag
+    if request.if_none_match.contains(tag) or request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+        resp.set_etag(tag)
+        return resp
+    resp = app.response_class(body, mimetype='application/json')
+    resp.set_etag(etag)
+    return resp
 
 @app.route('/api/buses', methods=['POST'])
 @jwt_required()
@@ -167,67 +526,75 @@ def add_bus():
     data = request.get_json(force=True)
     name = data.get('name')
     route = data.get('route')
-    lat = data.get('lat', 0.0)
-    lng = data.get('lng', 0.0)
     driver = data.get('driver', 'New Driver')
 
     if not name or not route:
         return jsonify({'msg': 'Name and route are required'}), 400
+    try:
+        position = parse_telemetry({'lat': data.get('lat', 0.0), 'lng': data.get('lng', 0.0)})
+    except ValueError as e:
+        return jsonify({'msg': str(e)}), 400
 
-    bus = Bus(name=name, route=route, lat=lat, lng=lng, driver=driver)
+    bus = Bus(name=name, route=route, driver=driver)
     db.session.add(bus)
     db.session.commit()
-    return jsonify({'msg': 'Bus added', 'bus': bus.to_dict()}), 201
+    try:
+        telemetry = save_telemetry(bus.id, position)
+    finally:
+        bump_bus_list_version()
+    return jsonify({'msg': 'Bus added', 'bus': bus.to_dict(telemetry)}), 201
 
 @app.route('/api/buses/<int:bus_id>', methods=['PUT'])
 @jwt_required()
 def update_bus(bus_id):
-    bus = Bus.query.get_or_404(bus_id)
     data = request.get_json(force=True)
-
-    for field in ('name', 'route', 'lat', 'lng', 'status', 'driver', 'speed', 'capacity', 'passengers'):
-        if field in data:
-            setattr(bus, field, data[field])
-
-    db.session.commit()
-    return jsonify({'msg': 'Updated', 'bus': bus.to_dict()}), 200
+    changed = {field: data[field] for field in BUS_FIELDS if field in data}
+    try:
+        telemetry = parse_telemetry(data)
+    except ValueError as e:
+        return jsonify({'msg': str(e)}), 400
+    return jsonify({'msg': 'Updated', 'bus': update_bus_row(bus_id, changed, telemetry)}), 200
 
 @app.route('/api/buses/<int:bus_id>/action', methods=['POST'])
 @jwt_required()
 def bus_action(bus_id):
-    bus = Bus.query.get_or_404(bus_id)
     data = request.get_json(force=True)
     action = data.get('action')
 
+    values, telemetry = {}, {}
     if action == 'emergency_stop':
-        bus.status = 'Emergency Stop'
+        values = {'status': 'Emergency Stop'}
     elif action == 'set_status' and 'status' in data:
-        bus.status = data['status']
+        values = {'status': data['status']}
     elif action == 'update_passengers' and 'passengers' in data:
-        bus.passengers = int(data['passengers'])
+        try:
+            telemetry = parse_telemetry({'passengers': data['passengers']})
+        except ValueError as e:
+            return jsonify({'msg': str(e)}), 400
     else:
         return jsonify({'msg': 'Unknown action or missing parameters'}), 400
 
-    db.session.commit()
-    return jsonify({'msg': 'Action applied', 'bus': bus.to_dict()}), 200
+    return jsonify({'msg': 'Action applied', 'bus': update_bus_row(bus_id, values, telemetry)}), 200
 
 @app.route('/api/emergency', methods=['POST'])
 @jwt_required()
 def emergency_all():
-    # Set all buses to Emergency Stop
-    buses = Bus.query.all()
-    for b in buses:
-        b.status = 'Emergency Stop'
+    # Set all buses to Emergency Stop in a single UPDATE statement
+    affected = db.session.query(Bus).update({Bus.status: 'Emergency Stop'}, synchronize_session=False)
     db.session.commit()
-    return jsonify({'msg': 'Emergency applied to all buses', 'affected': len(buses)}), 200
+    bump_bus_list_version()
+    return jsonify({'msg': 'Emergency applied to all buses', 'affected': affected}), 200
 
 @app.route('/api/report', methods=['GET'])
 @jwt_required()
 def generate_report():
-    buses = Bus.query.all()
-    report = []
-    for b in buses:
-        report.append(f"{b.name} - {b.route} - {b.status} - {b.passengers}/{b.capacity} passengers")
+    rows = db.session.execute(select(Bus.id, Bus.name, Bus.route, Bus.status, Bus.capacity)).all()
+    passengers = {doc['_id']: doc.get('passengers', 0) for doc in mongo.db.buses.find({}, {'passengers': 1})}
+    get_passengers = passengers.get
+    report = [
+        '%s - %s - %s - %s/%s passengers' % (name, route, status, get_passengers(bus_id, 0), capacity)
+        for bus_id, name, route, status, capacity in rows
+    ]
     return jsonify({'report': report}), 200
 
 # --- Simple bootstrap endpoint for dev ---------------------
@@ -235,7 +602,22 @@ def generate_report():
 def index():
     return jsonify({'msg': 'Navi X backend alive'})
 
-# --- Seed some buses for development -----------------------
+# --- Storage setup / dev data -----------------------------
+@app.cli.command('init-db')
+def init_db():
+    db.create_all()
+    # create_all doesn't alter existing tables; add columns introduced after the first release
+    if 'doc_sha256' not in {c['name'] for c in inspect(db.engine).get_columns('authority')}:
+        with db.engine.begin() as conn:
+            conn.execute(text('ALTER TABLE authority ADD COLUMN doc_sha256 VARCHAR(64)'))
+    create_telemetry_indexes()
+    print('Initialized SQLite tables and Mongo indexes')
+
+@app.cli.command('calibrate-argon2')
+def calibrate_argon2():
+    memory_cost = _tune_hasher().memory_cost
+    print(f'ARGON2_MEMORY_COST={memory_cost}  # budget {ARGON2_TARGET_SECONDS * 1000:.0f} ms per hash on this host')
+
 @app.cli.command('seed')
 def seed_data():
     if Bus.query.count() == 0:
@@ -247,16 +629,26 @@ def seed_data():
             {'name': 'University E5', 'route': 'Route 505'},
             {'name': 'Hospital F6', 'route': 'Route 606'},
         ]
-        for s in sample:
-            b = Bus(name=s['name'], route=s['route'], lat=22.5726 + (0.01 - 0.02 * (s['name'].__hash__() % 10)), lng=88.3639 + (0.01 - 0.02 * (s['route'].__hash__() % 10)), status='On Time', driver='Driver X', speed=20)
-            db.session.add(b)
+        rows = [{'name': s['name'], 'route': s['route'], 'status': 'On Time', 'driver': 'Driver X'} for s in sample]
+        db.session.execute(insert(Bus), rows)
         db.session.commit()
         print('Seeded buses')
     else:
         print('Buses already present')
 
-if __name__ == '__main__':
-    with app.app_context():
-        db.create_all()  # ✅ This creates all tables before starting the app
-    app.run(debug=True)
-
+    # Backfill telemetry for buses without a document, so rerunning repairs a seed whose Mongo write failed
+    have = {doc['_id'] for doc in mongo.db.buses.find({}, {'_id': 1})}
+    missing = [row for row in db.session.execute(select(Bus.id, Bus.name, Bus.route)) if row.id not in have]
+    if missing:
+        create_telemetry_indexes()
+        mongo.db.buses.with_options(write_concern=TELEMETRY_WRITE_CONCERN).bulk_write([
+            UpdateOne({'_id': bus_id}, telemetry_update({
+                # crc32 rather than hash(): str hashes are salted per process (PYTHONHASHSEED)
+                'lat': 22.5726 + (0.01 - 0.02 * (zlib.crc32(name.encode()) % 10)),
+                'lng': 88.3639 + (0.01 - 0.02 * (zlib.crc32(route.encode()) % 10)),
+                'speed': 20,
+            }), upsert=True)
+            for bus_id, name, route in missing
+        ])
+        bump_bus_list_version()
+        print(f'Seeded telemetry for {len(missing)} buses')
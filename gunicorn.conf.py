@@ -0,0 +1,17 @@
+import multiprocessing
+import os
+
+# gevent workers overlap Mongo/Redis and other network I/O; one process per core.
+# sqlite3 and Argon2 run in C that gevent can't patch, so each query or hash blocks its whole worker.
+# With several workers, set RATELIMIT_STORAGE_URI=redis://... or the login limit is per worker (workers x 10/min);
+# behind nginx also set TRUSTED_PROXY_HOPS so limits key on the client IP, not the proxy's.
+# The app then trusts X-Forwarded-For, so only listen where the proxy can reach it: loopback by
+# default, or a unix socket via GUNICORN_BIND=unix:/run/navi_x.sock (nginx: proxy_pass http://unix:...)
+wsgi_app = 'wsgi:app'
+bind = os.environ.get(
+    'GUNICORN_BIND', '127.0.0.1:5000' if int(os.environ.get('TRUSTED_PROXY_HOPS', '0')) else '0.0.0.0:5000'
+)
+worker_class = 'gevent'
+workers = multiprocessing.cpu_count()
+worker_connections = 1000
+keepalive = 5
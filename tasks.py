@@ -0,0 +1,19 @@
+# Background jobs for the `uploads` rq queue: rq worker uploads --url "$REDIS_URL"
+import hashlib
+
+from sqlalchemy import update
+
+from backend import app, db, Authority
+
+
+def postprocess_upload(authority_id, filepath):
+    # Work on a stored registration document that shouldn't hold up the HTTP request
+    # file_digest reads in fixed-size chunks into OpenSSL's SHA-256 (SHA-NI on x86 with OpenSSL >= 3.0)
+    with open(filepath, 'rb') as f:
+        digest = hashlib.file_digest(f, 'sha256')
+
+    with app.app_context():
+        db.session.execute(
+            update(Authority).where(Authority.id == authority_id).values(doc_sha256=digest.hexdigest())
+        )
+        db.session.commit()
@@ -0,0 +1,7 @@
+# Production entry point: gunicorn -c gunicorn.conf.py wsgi:app
+# Run `flask --app backend init-db` once before the first start.
+from gevent import monkey
+
+monkey.patch_all()  # must run before anything imports socket/ssl/threading
+
+from backend import app  # noqa: E402